@@ -1,7 +1,12 @@
 
-import json
-from difflib import get_close_matches
+import html
+import os
+import threading
+import markdown
+import orjson
 import streamlit as st
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
 from pathlib import Path
 
 # Page configuration
@@ -13,16 +18,30 @@ st.set_page_config(
 )
 
 # Custom CSS
-st.markdown(
-    """
+CUSTOM_CSS = """
     <style>
         MainMenu {visibility: hidden;}
         footer {visibility: hidden;}
         .scrollable-chat {
-            max-height: calc(100vh - 200px);
-            overflow-y: auto;
             padding-top: 1rem;
         }
+        .chat-message {
+            padding: 0.5rem 1rem;
+            margin-bottom: 0.75rem;
+            border-radius: 0.75rem;
+            max-width: 85%;
+        }
+        .chat-message p:last-child {
+            margin-bottom: 0;
+        }
+        .chat-message.user {
+            background-color: #f0f2f6;
+            margin-left: auto;
+        }
+        .chat-message.assistant {
+            background-color: #e8f0fe;
+            margin-right: auto;
+        }
         [data-testid="stSidebar"] {
             background-color: white;
             padding: 1rem;
@@ -54,39 +73,178 @@ st.markdown(
             max-width: 600px;
         }
     </style>
-    """, 
-    unsafe_allow_html=True
-)
+    """
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # -------------------------------------------------------------------------------------
 
-def load_knowledge_base(file_path: str) -> dict:
-    """Load the knowledge base from a JSON file."""
+KNOWLEDGE_BASE_FILE = "knowledge_base.jsonl"
+
+def get_mtime(file_path: str) -> float:
+    """Return the modification time of a file, or 0.0 if it does not exist."""
     try:
-        with open(file_path, 'r') as file:
-            return json.load(file)
+        return Path(file_path).stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+@st.cache_resource
+def get_knowledge_base_lock() -> threading.Lock:
+    """Return the lock that serializes writes to the knowledge base (shared across sessions)."""
+    return threading.Lock()
+
+def is_valid_entry(entry) -> bool:
+    """Check that a decoded value is a Q&A entry with string question and answer."""
+    return (
+        isinstance(entry, dict)
+        and isinstance(entry.get("question"), str)
+        and isinstance(entry.get("answer"), str)
+    )
+
+def parse_knowledge_base(content: bytes) -> tuple[dict, list[bytes], bool]:
+    """Parse JSON Lines content into the knowledge base, its unreadable lines, and whether entries were migrated."""
+    data = {"questions": []}
+    bad_lines = []
+    migrated = False
+    # Windows editors may prepend a UTF-8 byte order mark
+    for line in content.removeprefix(b"\xef\xbb\xbf").splitlines():
+        if not line.strip():
+            continue
+        try:
+            entry = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            bad_lines.append(line)
+            continue
+        if not is_valid_entry(entry):
+            bad_lines.append(line)
+            continue
+        # Populate the normalized question for entries saved before it existed
+        if "question_lc" not in entry:
+            entry["question_lc"] = entry["question"].casefold()
+            migrated = True
+        data["questions"].append(entry)
+    return data, bad_lines, migrated
+
+def import_legacy_knowledge_base(legacy_path: Path, file_path: str):
+    """Append new entries of a legacy JSON knowledge base to the JSON Lines file (caller holds the knowledge base lock)."""
+    try:
+        data = orjson.loads(legacy_path.read_bytes().removeprefix(b"\xef\xbb\xbf"))
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("questions"), list):
+        st.error(f"Error reading the legacy knowledge base {legacy_path.name}. It was not imported.")
+        return
+    
+    path = Path(file_path)
+    known = set()
+    if path.exists():
+        current, _, _ = parse_knowledge_base(path.read_bytes())
+        known = {q["question_lc"] for q in current["questions"]}
+    
+    # Skip questions the JSON Lines file already has, such as the bundled ones
+    new_entries = []
+    for q in data["questions"]:
+        if not is_valid_entry(q):
+            continue
+        question_lc = q["question"].casefold()
+        if question_lc not in known:
+            known.add(question_lc)
+            new_entries.append({"question": q["question"], "question_lc": question_lc, "answer": q["answer"]})
+    if new_entries:
+        append_entries(file_path, new_entries)
+    legacy_path.replace(legacy_path.with_suffix(legacy_path.suffix + ".migrated"))
+
+@st.cache_data(show_spinner=False)
+def load_knowledge_base(file_path: str, mtime: float) -> dict:
+    """Load the knowledge base from a JSON Lines file (cached per file version)."""
+    path = Path(file_path)
+    # One-off migration from the JSON file used before the JSON Lines log
+    legacy_path = path.with_suffix(".json")
+    if legacy_path.exists():
+        with get_knowledge_base_lock():
+            if legacy_path.exists():
+                import_legacy_knowledge_base(legacy_path, file_path)
+    try:
+        content = path.read_bytes()
     except FileNotFoundError:
         return {"questions": []}
-    except json.JSONDecodeError:
-        st.error("Error reading the knowledge base. Starting fresh.")
-        return {"questions": []}
+    
+    data, bad_lines, migrated = parse_knowledge_base(content)
+    if bad_lines or migrated:
+        with get_knowledge_base_lock():
+            # Re-read under the lock so entries appended since the first read are not lost
+            data, bad_lines, migrated = parse_knowledge_base(path.read_bytes())
+            bad_path = path.with_suffix(path.suffix + ".bad")
+            if bad_lines:
+                # Keep unreadable lines aside instead of dropping them on compaction
+                with open(bad_path, "ab") as file:
+                    file.write(b"".join(line + b"\n" for line in bad_lines))
+            if bad_lines or migrated:
+                compact_knowledge_base(file_path, data)
+        if bad_lines:
+            st.error(f"Moved {len(bad_lines)} unreadable entries of the knowledge base to {bad_path.name}.")
+    return data
 
-def save_knowledge_base(file_path: str, data: dict):
-    """Save the knowledge base to a JSON file."""
-    with open(file_path, "w") as file:
-        json.dump(data, file, indent=2)
+def compact_knowledge_base(file_path: str, data: dict):
+    """Rewrite the knowledge base file with one entry per line (caller holds the knowledge base lock)."""
+    # Write and fsync a temporary file, then swap it in so a crash never leaves a truncated file
+    path = Path(file_path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as file:
+        file.write(b"".join(orjson.dumps(q) + b"\n" for q in data["questions"]))
+        file.flush()
+        os.fsync(file.fileno())
+    tmp.replace(path)
+
+def append_entries(file_path: str, entries: list[dict]):
+    """Append entries to the knowledge base file (caller holds the knowledge base lock)."""
+    with open(file_path, "a+b") as file:
+        # Terminate a last line left without a newline so the entries do not get glued onto it
+        separator = b""
+        if file.seek(0, os.SEEK_END) > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                separator = b"\n"
+        file.write(separator + b"".join(orjson.dumps(entry) + b"\n" for entry in entries))
+
+def save_knowledge_base(file_path: str, entry: dict):
+    """Append a new Q&A entry to the knowledge base file."""
+    with get_knowledge_base_lock():
+        append_entries(file_path, [entry])
+    load_knowledge_base.clear()
+    build_answer_index.clear()
+    get_match_index.clear()
+
+@st.cache_resource(show_spinner=False)
+def get_match_index(file_path: str, mtime: float) -> dict:
+    """Build the question list used for fuzzy matching (shared across sessions)."""
+    entries = load_knowledge_base(file_path, mtime)["questions"]
+    return {"questions": [q["question"] for q in entries]}
 
 def find_best_match(user_question: str, questions: list[str]) -> str | None:
     """Find the closest matching question from the knowledge base."""
-    matches = get_close_matches(user_question, questions, n=1, cutoff=0.6)
-    return matches[0] if matches else None
+    # Imported lazily so exact-match lookups never pay the import cost
+    from rapidfuzz import process, fuzz, utils
+    match = process.extractOne(user_question, questions, scorer=fuzz.ratio, processor=utils.default_process, score_cutoff=60)
+    return match[0] if match else None
 
-def get_answer(question: str, knowledge_base: dict) -> str | None:
-    """Get the answer for a question from the knowledge base."""
+@st.cache_resource(show_spinner=False)
+def build_answer_index(file_path: str, mtime: float) -> dict[str, str]:
+    """Map each normalized question to its answer (shared across sessions)."""
+    knowledge_base = load_knowledge_base(file_path, mtime)
+    answer_index = {}
     for q in knowledge_base["questions"]:
-        if q["question"].lower() == question.lower():
-            return q["answer"]
-    return None
+        # Keep the first answer for duplicate questions, as the linear scan did
+        answer_index.setdefault(q["question_lc"], q["answer"])
+    return answer_index
+
+def get_answer(question: str, answer_index: dict[str, str]) -> str | None:
+    """Get the answer for a question from the answer index."""
+    return answer_index.get(question.casefold())
+
+@st.cache_data(show_spinner=False)
+def get_trainer_password() -> str:
+    """Read the trainer password from secrets (cached per process)."""
+    return st.secrets["TRAINER_PASSWORD"]
 
 def check_password():
     """Check if the user has entered the correct password."""
@@ -97,7 +255,7 @@ def check_password():
         return True
     
     try:
-        correct_password = st.secrets["TRAINER_PASSWORD"]
+        correct_password = get_trainer_password()
     except:
         st.error("Password not configured. Please set TRAINER_PASSWORD in secrets.")
         return False
@@ -113,6 +271,80 @@ def check_password():
     
     return False
 
+@st.fragment
+def display_training_form():
+    """Display the training form; interactions here rerun only this fragment."""
+    if not check_password():
+        return
+    
+    with st.form("teach_form"):
+        st.write(f"Training for question: '{st.session_state.current_question}'")
+        new_answer = st.text_area("Please provide the answer:", key="new_answer")
+        submit = st.form_submit_button("Train the bot")
+        cancel = st.form_submit_button("Cancel")
+        
+        if submit and new_answer:
+            # Add new Q&A to knowledge base
+            save_knowledge_base(KNOWLEDGE_BASE_FILE, {
+                "question": st.session_state.current_question,
+                "question_lc": st.session_state.current_question.casefold(),
+                "answer": new_answer
+            })
+            
+            st.session_state.messages.append({
+                "role": "assistant", 
+                "content": f"Thank you! I've learned: '{st.session_state.current_question}'"
+            })
+            st.session_state.awaiting_answer = False
+            st.session_state.current_question = ""
+            st.rerun()
+        
+        if cancel:
+            st.session_state.messages.append({
+                "role": "assistant", 
+                "content": "Okay, let's continue our conversation."
+            })
+            st.session_state.awaiting_answer = False
+            st.session_state.current_question = ""
+            st.rerun()
+
+SAFE_URL_SCHEMES = {"http", "https", "mailto"}
+
+def is_safe_url(url: str) -> bool:
+    """Check that a link target is relative or uses an allowed URL scheme."""
+    # Browsers decode entities and ignore whitespace/control characters in the scheme
+    url = "".join(ch for ch in html.unescape(url) if ch > " ").lower()
+    scheme, sep, _ = url.partition(":")
+    return not sep or any(c in scheme for c in "/?#") or scheme in SAFE_URL_SCHEMES
+
+class SafeLinksTreeprocessor(Treeprocessor):
+    """Drop link and image targets that fail is_safe_url."""
+    def run(self, root):
+        for element in root.iter():
+            for attr in ("href", "src"):
+                if attr in element.attrib and not is_safe_url(element.get(attr)):
+                    del element.attrib[attr]
+
+class SafeMarkdownExtension(Extension):
+    """Render raw HTML as text and strip unsafe link targets."""
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+        md.treeprocessors.register(SafeLinksTreeprocessor(md), "safe_links", -1)
+
+@st.cache_data(show_spinner=False, max_entries=1000)
+def render_message(content: str) -> str:
+    """Render a message's markdown to HTML with raw HTML and unsafe links disabled."""
+    return markdown.Markdown(extensions=["fenced_code", "tables", SafeMarkdownExtension()]).convert(content)
+
+def render_chat_history(messages: list[dict]) -> str:
+    """Build the whole chat history as a single HTML block."""
+    bubbles = "\n".join(
+        f'<div class="chat-message {message["role"]}">{render_message(message["content"])}</div>'
+        for message in messages
+    )
+    return f'<div class="scrollable-chat">{bubbles}</div>'
+
 def display_chat():
     """Display the chat interface with centered input on startup."""
     
@@ -143,11 +375,8 @@ def display_chat():
     
     # Display chat messages
     with st.container():
-        st.markdown('<div class="scrollable-chat">', unsafe_allow_html=True)
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-        st.markdown('</div>', unsafe_allow_html=True)
+        # st.html inserts the block as-is, so Streamlit's markdown parser cannot split it
+        st.html(render_chat_history(st.session_state.messages))
     
     # Handle quit state
     if not st.session_state.chat_active:
@@ -155,8 +384,9 @@ def display_chat():
         return
     
     # Load knowledge base
-    knowledge_base = load_knowledge_base("knowledge_base.json")
-    questions = [q["question"] for q in knowledge_base["questions"]]
+    mtime = get_mtime(KNOWLEDGE_BASE_FILE)
+    match_index = get_match_index(KNOWLEDGE_BASE_FILE, mtime)
+    answer_index = build_answer_index(KNOWLEDGE_BASE_FILE, mtime)
     
     # Determine input position (centered on first interaction, bottom afterwards)
     input_class = "centered-input" if st.session_state.first_interaction and not st.session_state.messages else "bottom-input"
@@ -176,11 +406,14 @@ def display_chat():
         st.session_state.messages.append({"role": "user", "content": prompt})
         
         if not st.session_state.awaiting_answer:
-            # Find best match and respond
-            best_match = find_best_match(prompt, questions)
+            # Try an exact match first, then fall back to fuzzy matching
+            answer = get_answer(prompt, answer_index)
+            if answer is None:
+                best_match = find_best_match(prompt, match_index["questions"])
+                if best_match:
+                    answer = get_answer(best_match, answer_index)
             
-            if best_match:
-                answer = get_answer(best_match, knowledge_base)
+            if answer is not None:
                 st.session_state.messages.append({"role": "assistant", "content": answer})
             else:
                 st.session_state.messages.append({
@@ -192,37 +425,8 @@ def display_chat():
     st.markdown('</div>', unsafe_allow_html=True)
     
     # Training mode - only if authenticated
-    if st.session_state.current_question and check_password():
-        with st.form("teach_form"):
-            st.write(f"Training for question: '{st.session_state.current_question}'")
-            new_answer = st.text_area("Please provide the answer:", key="new_answer")
-            submit = st.form_submit_button("Train the bot")
-            cancel = st.form_submit_button("Cancel")
-            
-            if submit and new_answer:
-                # Add new Q&A to knowledge base
-                knowledge_base["questions"].append({
-                    "question": st.session_state.current_question,
-                    "answer": new_answer
-                })
-                save_knowledge_base("knowledge_base.json", knowledge_base)
-                
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": f"Thank you! I've learned: '{st.session_state.current_question}'"
-                })
-                st.session_state.awaiting_answer = False
-                st.session_state.current_question = ""
-                st.rerun()
-            
-            if cancel:
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": "Okay, let's continue our conversation."
-                })
-                st.session_state.awaiting_answer = False
-                st.session_state.current_question = ""
-                st.rerun()
+    if st.session_state.current_question:
+        display_training_form()
 
 if __name__ == "__main__":
     display_chat()